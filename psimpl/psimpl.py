@@ -10,6 +10,7 @@ See http://www.apache.org/licenses/LICENSE-2.0
 from __future__ import with_statement
 
 import subprocess
+import multiprocessing as mp
 from psimpl.psimpl_lib import *
 
 def impute_and_write_pin(args):
@@ -22,7 +23,8 @@ def impute_and_write_pin(args):
     # Instantiate main imputation object
     pi = psm_imputer(args.pin, 
                      verb = args.verbose,
-                     debug_mode = args.turn_on_debug_mode)
+                     debug_mode = args.turn_on_debug_mode,
+                     num_threads = args.num_threads)
 
     # Check whether we're working with subset of features
     if args.use_subset_of_features: # Parse supplied features
@@ -66,6 +68,8 @@ def main():
 
     psimplGroup.add_argument('--gzip-output', action='store_true', help = 'Compress output file using gzip.')
 
+    psimplGroup.add_argument('--num-threads', type = int, action= 'store', default=mp.cpu_count(), help = 'Number of threads used to fit regressors for different features with missing values.  Each fit may also use multithreaded BLAS; if the machine is oversubscribed, lower this or limit BLAS threads (e.g., OMP_NUM_THREADS).')
+
     _args = parser.parse_args()
 
     assert _args.pin != None, "Please supply Percolator PIN file to impute missing values"
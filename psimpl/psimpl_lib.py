@@ -10,17 +10,28 @@ See http://www.apache.org/licenses/LICENSE-2.0
 from __future__ import with_statement
 
 import gzip
+import io
 import os
 import csv
 import argparse
-import random
 import re
+import shutil
+import subprocess
 
 from sklearn import linear_model
+from sklearn.base import clone
+from joblib import Parallel, delayed
 
 import numpy as np
+import pandas as pd
 import multiprocessing as mp
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError: # fall back to the pandas parser
+    pa = None
+
 try:
     import matplotlib
     import matplotlib.pyplot as plt
@@ -32,6 +43,9 @@ except ImportError:
 
 _impute_debug = True
 
+# Peptide string with flanking amino acids, i.e., left.peptide.right
+_flanked_peptide_re = re.compile(r'^([^.]+)\.(.+)\.([^.]+)$')
+
 #####################################################
 #####################################################
 ####   General plotting functions
@@ -44,8 +58,8 @@ def histogram(targets, decoys, output, bins = 40, prob = False,
     """Histogram of the score distribution between target and decoy PSMs.
 
     Arguments:
-        targets: Iterable of floats, each the score of a target PSM.
-        decoys: Iterable of floats, each the score of a decoy PSM.
+        targets: Array (or iterable) of floats, each the score of a target PSM.
+        decoys: Array (or iterable) of floats, each the score of a decoy PSM.
         fn: Name of the output file. The format is inferred from the
             extension: e.g., foo.png -> PNG, foo.pdf -> PDF. The image
             formats allowed are those supported by matplotlib: png,
@@ -56,24 +70,30 @@ def histogram(targets, decoys, output, bins = 40, prob = False,
         Outputs the image to the file specified in 'output'.
 
     """
-    l = min(min(decoys), min(targets))
-    h = max(max(decoys), max(targets))
+    targets = np.asarray(targets)
+    decoys = np.asarray(decoys)
+    l = min(decoys.min(), targets.min())
+    h = max(decoys.max(), targets.max())
+    target_counts, edges = np.histogram(targets, bins = bins, range = (l,h), density = prob)
+    decoy_counts, _ = np.histogram(decoys, bins = edges, density = prob)
     pylab.clf()
-    _, _, h1 = pylab.hist(targets, bins = bins, range = (l,h), density = prob,
-                          color = 'b', alpha = 0.25)
-    _, _, h2 = pylab.hist(decoys, bins = bins, range = (l,h), density = prob,
-                          color = 'm', alpha = 0.25)
+    h1 = pylab.bar(edges[:-1], target_counts, width = np.diff(edges), align = 'edge',
+                   color = 'b', alpha = 0.25)
+    h2 = pylab.bar(edges[:-1], decoy_counts, width = np.diff(edges), align = 'edge',
+                   color = 'm', alpha = 0.25)
     pylab.legend((h1[0], h2[0]), (target_string, decoy_string), loc = 'best')
     pylab.savefig('%s' % output)
 
 def histogram_singleDist(scores, output, xax, htitle, bins = 100, prob = False, filterAroundZero = False):
     """Histogram of a score distribution.
     """
+    scores = np.asarray(scores)
     if filterAroundZero:
         m = np.mean(scores)
         std = np.std(scores)
-        scores = [s for s in scores if abs(s) > m+3*std]
-    _, _, h1 = plt.hist(scores, bins = bins, range = (min(scores),max(scores)), density = prob, color = 'b')
+        scores = scores[np.abs(scores) > m+3*std]
+    counts, edges = np.histogram(scores, bins = bins, range = (scores.min(), scores.max()), density = prob)
+    plt.bar(edges[:-1], counts, width = np.diff(edges), align = 'edge', color = 'b')
     plt.xlabel(xax)
     plt.title(htitle)
     plt.tight_layout()
@@ -87,115 +107,131 @@ def histogram_singleDist(scores, output, xax, htitle, bins = 100, prob = False,
 #####################################################
 #####################################################
 def checkGzip_openfile(filename, mode = 'r'):
+    """ Open text file for reading/writing, (de)compressing files with a .gz extension
+
+        Gzip streams are wrapped in 1 MB buffered readers/writers, so that many small
+        reads/writes are batched before passing through zlib.  When available, gzip
+        files are decompressed for reading by a separate gzip process, which runs
+        concurrently with parsing
+    """
     if os.path.splitext(filename)[1] == '.gz':
-        return gzip.open(filename, mode)
+        if 'w' in mode:
+            return io.TextIOWrapper(io.BufferedWriter(gzip.open(filename, 'wb'), buffer_size = 1 << 20), 
+                                    encoding = 'utf-8')
+        if shutil.which('gzip'):
+            return decompression_pipe(['gzip', '-dc', filename])
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(filename, 'rb'), buffer_size = 1 << 20), 
+                                encoding = 'utf-8', newline = '')
     else:
         return open(filename, mode)
 
-def find_missingVals(filename, 
-                     nonFeatureKeys = ['PSMId', 'ScanNr', 'Label', 'peptide', 'proteinIds'],
-                     missingValueList = ['NA', 'na'],
-                     load_observedVals = True, 
-                     verb = 0):
-    """ Parse Percolator PIN file and find rows/features with missing values
-
-        For n input features and m total file fields, the file format is:
-        header field 1: SpecId, or other PSM id
-        header field 2: Label, denoting whether the PSM is a target or decoy
-        header field 3 : Input feature 1
-        header field 4 : Input feature 2
-        ...
-        header field n + 2 : Input feature n
-        header field n + 3: Peptide, the peptide string
-        header field n + 4: Protein id 1
+def load_pin_dataframe(filename, missingValueList = ['NA', 'na']):
+    """ Load Percolator PIN file into a pandas DataFrame using a single, C-level parse
 
         inputs:
-        filename = PIN/tab-delimited file to load features and PSM info of
-        nonFeatureKeys = fields which are not going into the feature matrix (often PSM meta info)
-        missingValueList = list of possible missing value strings.  These values will be imputed and filled in
-    """
-    f = open(filename, 'r')
-    r = csv.DictReader(f, delimiter = '\t', skipinitialspace = True)
-    headerInOrder = r.fieldnames
-
-    # Check header fields
-    psmId_field = 'SpecId'
-    if psmId_field not in headerInOrder:
-        psmId_field = 'PSMId'
-    nonFeatureKeys[0] = psmId_field
-
-    peptideKey = 'peptide'
-    if peptideKey not in headerInOrder:
-        peptideKey = 'Peptide'
-        assert peptideKey in headerInOrder, 'PIN file does not contain peptide column, exitting'
-    nonFeatureKeys[2] = peptideKey
+        filename = PIN/tab-delimited file to load
+        missingValueList = list of possible missing value strings, loaded as NaN
 
-    proteinKey = 'proteinIds'
-    if proteinKey not in headerInOrder:
-        proteinKey = 'Proteins'
-        assert proteinKey in headerInOrder, 'PIN file does not contain protein column, exitting'
-    nonFeatureKeys[3] = proteinKey
+        Only fields named in the header are loaded; protein ids spilling past the last
+        header field (i.e., tab-delimited protein lists) are tab-joined into that field.
 
-    assert set(nonFeatureKeys) & set(headerInOrder), "%s does not contain proper fields (%s,%s,%s,%s,) exitting" (filename, nonFeatureKeys[0],
-                                                                                                                  nonFeatureKeys[1],nonFeatureKeys[2],
-                                                                                                                  nonFeatureKeys[3])
-    na_tracker = missing_value_tracker(missingValueList)
-    missingValues = set(missingValueList)
-    # missing features and PSM IDs
-    na_features = set([])
-    na_psm_inds = []
-
-    constKeys = set(nonFeatureKeys) # exclude these when reserializing data
-    keys = []
-
-    if verb > 0:
-        print("Header fields for PIN file:")
-        print(headerInOrder)
-
-    for h in headerInOrder: # keep order of keys intact
-        if h not in constKeys and h != '':
-            keys.append(h)
-    featureNames = []
-    for k in keys:
-        featureNames.append(k)  
-
-    for i, l in enumerate(r):
-        # proteinId field may have contained tabs
-        if(None in l): 
-            for extraProteinId in l[None]:
-                l[proteinKey] += '\t' + extraProteinId
-        psmId = l[psmId_field]
+        If available, pyarrow's multithreaded parser is used.  PIN files it cannot
+        parse (rows with tab-delimited protein lists) are loaded using pandas, with
+        round-trip float parsing so that both parsers load identical values.
+    """
+    headerInOrder = list(pd.read_csv(filename, sep = '\t', nrows = 0).columns)
+    fields = [h for h in headerInOrder if not h.startswith('Unnamed:')]
+    if pa is not None:
+        pin_df = load_pin_dataframe_pyarrow(filename, fields, missingValueList)
+        if pin_df is not None:
+            return pin_df
+    return load_pin_dataframe_pandas(filename, headerInOrder, fields, missingValueList)
+
+def load_pin_dataframe_pandas(filename, headerInOrder, fields, missingValueList = ['NA', 'na']):
+    """ Load fields of PIN file using pandas, tab-joining protein ids past the last header field
+
+        Rows wider than the header are read into extra columns, widening the parse
+        and retrying whenever pandas encounters a row wider than the current columns
+    """
+    # pandas truncates, rather than fails on, a first row wider than the columns read
+    with checkGzip_openfile(filename, 'r') as f:
+        f.readline()
+        numFields = max(len(headerInOrder), len(f.readline().rstrip('\r\n').split('\t')))
+    while True:
+        extraFields = ['Unnamed: %d' % i for i in range(len(headerInOrder), numFields)]
         try:
-            y = int(l["Label"])
-        except ValueError:
-            print("Could not convert label %s on line %d to int, exitting" % (l["Label"], i+1))
-            exit(-1)
-        if y != 1 and y != -1:
-            print("Error: encountered label value %d on line %d, can only be -1 or 1, exitting" % (y, i+1))
-            exit(-2)
-        el = []
-        for j, k in enumerate(keys):
-            try:
-                el.append(float(l[k]))
-            except ValueError:
-                if(l[k] in missingValues):
-                    el.append(0.)
-                    na_tracker.found_missing_value(k, i, j, psmId)
-                else:
-                    print(keys)
-                    print(l)
-                    print("Could not convert feature %s with value %s to float, exitting" % (k, l[k]))
-                    exit(-3)
-    f.close()
-    return na_tracker
-
-def load_percolator_feature_matrix(filename, 
-                                   countUniquePeptides = False, 
-                                   message = '', 
-                                   na_rows = set([]),
-                                   na_features = set([]),
-                                   feature_subset = None):
-    """ Load Percolator feature matrix generated for each crossvalidation test bin
+            with checkGzip_openfile(filename, 'r') as f:
+                pin_df = pd.read_csv(f, sep = '\t', skipinitialspace = True,
+                                     header = None, skiprows = 1, index_col = False,
+                                     names = headerInOrder + extraFields,
+                                     dtype = dict.fromkeys(fields[-1:] + extraFields, str),
+                                     na_values = missingValueList, keep_default_na = False,
+                                     float_precision = 'round_trip',
+                                     engine = 'c', low_memory = False)
+            break
+        except pd.errors.ParserError as e:
+            m = re.search(r'saw (\d+)', str(e))
+            if m is None:
+                raise
+            numFields = max(int(m.group(1)), 2 * numFields - len(headerInOrder))
+    proteinKey = fields[-1]
+    for field in extraFields:
+        spilled = (pin_df[field].notna() & (pin_df[field] != '')).to_numpy()
+        pin_df.loc[spilled, proteinKey] = pin_df.loc[spilled, proteinKey] + '\t' + pin_df.loc[spilled, field]
+    return pin_df[fields]
+
+def load_pin_dataframe_pyarrow(filename, fields, missingValueList = ['NA', 'na']):
+    """ Load fields of PIN file using pyarrow, returning None if any row has extra fields
+    """
+    try:
+        table = pacsv.read_csv(filename, 
+                               parse_options = pacsv.ParseOptions(delimiter = '\t'),
+                               convert_options = pacsv.ConvertOptions(include_columns = fields,
+                                                                      null_values = missingValueList,
+                                                                      strings_can_be_null = False))
+    except pa.ArrowInvalid:
+        return None
+    # Features which are missing for all PSMs have no inferred type
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas()
+
+def check_pin_labels(pin_df):
+    """ Check that all PSM labels are either 1 (target) or -1 (decoy), exit otherwise
+    """
+    labels = pd.to_numeric(pin_df["Label"], errors = 'coerce')
+    bad = np.flatnonzero(labels.isna().to_numpy())
+    if len(bad):
+        i = bad[0]
+        print("Could not convert label %s on line %d to int, exitting" % (pin_df["Label"].iloc[i], i+1))
+        exit(-1)
+    bad = np.flatnonzero(~labels.isin([1, -1]).to_numpy())
+    if len(bad):
+        i = bad[0]
+        print("Error: encountered label value %d on line %d, can only be -1 or 1, exitting" % (labels.iloc[i], i+1))
+        exit(-2)
+
+def check_pin_features(pin_df, keys):
+    """ Check that all features were parsed as numbers (or missing values), exit otherwise
+    """
+    for k in keys:
+        if pd.api.types.is_numeric_dtype(pin_df[k]):
+            continue
+        vals = pd.to_numeric(pin_df[k], errors = 'coerce')
+        i = np.flatnonzero((vals.isna() & pin_df[k].notna()).to_numpy())[0]
+        print(keys)
+        print("Could not convert feature %s with value %s to float, exitting" % (k, pin_df[k].iloc[i]))
+        exit(-3)
+
+def load_percolator_feature_matrix_with_nas(filename, 
+                                            countUniquePeptides = False, 
+                                            message = '', 
+                                            missingValueList = ['NA', 'na'],
+                                            feature_subset = None,
+                                            verb = 0,
+                                            pin_df = None):
+    """ Load Percolator feature matrix and find rows/features with missing values
 
         For n input features and m total file fields, the file format is:
         header field 1: SpecId, or other PSM id
@@ -206,10 +242,22 @@ def load_percolator_feature_matrix(filename,
         header field n + 2 : Input feature n
         header field n + 3: Peptide, the peptide string
         header field n + 4: Protein id 1
+
+        inputs:
+        filename = PIN/tab-delimited file to load features and PSM info of
+        missingValueList = list of possible missing value strings.  These values will be imputed and filled in
+        pin_df = PIN file already loaded by load_pin_dataframe; if None, filename is loaded
+
+        outputs:
+        na_tracker = missing_value_tracker detailing missing values in the feature matrix
+        X = feature matrix, with missing values set to zero
+        Y = PSM labels
+        psmStringInfo = psm_string_collection, a sequence of PSM objects
+        keys = feature names, in feature matrix column order
     """
-    f = open(filename, 'r')
-    r = csv.DictReader(f, delimiter = '\t', skipinitialspace = True)
-    headerInOrder = r.fieldnames
+    if pin_df is None:
+        pin_df = load_pin_dataframe(filename, missingValueList)
+    headerInOrder = list(pin_df.columns)
     nonFeatureKeys = ['PSMId', 'Label', 'peptide', 'proteinIds'] # , 'ScanNr']
 
     psmId_field = 'SpecId'
@@ -235,66 +283,91 @@ def load_percolator_feature_matrix(filename,
         exit(-1)
     nonFeatureKeys[3] = proteinKey
 
-    assert set(nonFeatureKeys) & set(headerInOrder), "%s does not contain proper fields (%s,%s,%s,%s,) exitting" (filename, nonFeatureKeys[0],
-                                                                                                                  nonFeatureKeys[1],nonFeatureKeys[2],
-                                                                                                                  nonFeatureKeys[3])
-    uniquePeptides = set([])
+    assert set(nonFeatureKeys) & set(headerInOrder), "%s does not contain proper fields (%s,%s,%s,%s,) exitting" % (filename, nonFeatureKeys[0],
+                                                                                                                    nonFeatureKeys[1],nonFeatureKeys[2],
+                                                                                                                    nonFeatureKeys[3])
+
+    if verb > 0:
+        print("Header fields for PIN file:")
+        print(headerInOrder)
 
     constKeys = set(nonFeatureKeys) # exclude these when reserializing data
     keys = []
     for h in headerInOrder: # keep order of keys intact
-        if h not in constKeys and h!= '':
+        if h not in constKeys:
             keys.append(h)
 
     if feature_subset and not feature_subset.is_empty:
         keys = feature_subset.return_overlapping_features(keys)
         print("Overlapping features:")
         print(keys)
-    featureNames = []
-    for k in keys:
-        featureNames.append(k)
-
-    features = []
-    Y = []
-    psmStringInfo = []
-    for i, l in enumerate(r):
-        # proteinId field may have contained tabs
-        if(None in l): 
-            for extraProteinId in l[None]:
-                l[proteinKey] += '\t' + extraProteinId
-        psmId = l[psmId_field]
-        try:
-            y = int(l["Label"])
-        except ValueError:
-            print("Could not convert label %s on line %d to int, exitting" % (l["Label"], i+1))
-            exit(-1)
-        if y != 1 and y != -1:
-            print("Error: encountered label value %d on line %d, can only be -1 or 1, exitting" % (y, i+1))
-            exit(-2)
-        el = []
-        for k in keys:
-            if i in na_rows and k in na_features:
-                el.append(0.)
-            else:
-                try:
-                    el.append(float(l[k]))
-                except ValueError:
-                    print("Could not convert feature %s with value %s to float, exitting" % (k, l[k]))
-                    exit(-3)
-        psmInfo = PSM(l[psmId_field], l[peptideKey], l[proteinKey])
-        if countUniquePeptides:
-            uniquePeptides.add(l[peptideKey])
-        features.append(el)
-        Y.append(y)
-        psmStringInfo.append(psmInfo)
-    f.close()
+
+    check_pin_labels(pin_df)
+    check_pin_features(pin_df, keys)
+
+    # Preallocate feature matrix and copy each column in directly, avoiding
+    # an intermediate (mixed-dtype) DataFrame copy.  Single precision suffices
+    # for PIN features and halves the memory traffic of regression fits.
+    # Missing values are located and zeroed in the same column-major pass;
+    # integer columns cannot contain missing values and are not scanned
+    X = np.empty((len(pin_df), len(keys)), dtype = np.float32)
+    na_rows = [np.empty(0, dtype = np.int64)]
+    na_cols = [np.empty(0, dtype = np.int64)]
+    for j, k in enumerate(keys):
+        col = pin_df[k].to_numpy()
+        X[:, j] = col
+        if col.dtype.kind == 'f':
+            rows = np.flatnonzero(np.isnan(col))
+            if len(rows):
+                X[rows, j] = 0.
+                na_rows.append(rows)
+                na_cols.append(np.full(len(rows), j))
+    na_rows = np.concatenate(na_rows)
+    na_cols = np.concatenate(na_cols)
+    # (row, col) pairs of missing values, in row-major order
+    order = np.lexsort((na_cols, na_rows))
+    na_rows = na_rows[order]
+    na_cols = na_cols[order]
+
+    na_tracker = missing_value_tracker(missingValueList)
+    na_tracker.found_missing_values([keys[j] for j in np.unique(na_cols)],
+                                    na_rows, na_cols,
+                                    pin_df[psmId_field].to_numpy()[na_rows].tolist())
+
+    Y = pin_df["Label"].to_numpy(dtype = np.int8)
+    psmStringInfo = psm_string_collection(pin_df[psmId_field].to_numpy(),
+                                          pin_df[peptideKey].to_numpy(),
+                                          pin_df[proteinKey].to_numpy())
 
     if countUniquePeptides:
         if message:
             print(message)
-        print("Loaded %d PSMs, %d unique Peptides" % (len(psmStringInfo), len(uniquePeptides)))
+        print("Loaded %d PSMs, %d unique Peptides" % (len(psmStringInfo), pin_df[peptideKey].nunique()))
 
-    return np.array(features), np.array(Y), psmStringInfo, keys
+    return na_tracker, X, Y, psmStringInfo, keys
+
+#####################################################
+#####################################################
+####   Regression functions
+#####################################################
+#####################################################
+def fit_and_impute_feature(regressor, X, y, X_missing, X_cv = None, y_cv = None):
+    """ Fit regressor for a single feature and predict its missing values
+
+        inputs:
+        regressor = unfitted regression object
+        X, y = fully observed training features and feature to impute
+        X_missing = features of rows where the feature to impute is missing
+        X_cv, y_cv = optional validation data
+
+        outputs:
+        imputed values for X_missing, validation score (None if no validation data)
+    """
+    regressor.fit(X, y)
+    validation_score = None
+    if X_cv is not None:
+        validation_score = regressor.score(X_cv, y_cv)
+    return regressor.predict(X_missing), validation_score
 
 #####################################################
 #####################################################
@@ -360,26 +433,55 @@ class simple_feature_string_collection(object):
                 subset_of_features.append(feature)
         return subset_of_features
 
+class decompression_pipe(io.TextIOWrapper):
+    """ Text stream reading the stdout of a decompression process
+    """
+    def __init__(self, cmd):
+        self.proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, bufsize = 1 << 20)
+        super(decompression_pipe, self).__init__(self.proc.stdout, encoding = 'utf-8', newline = '')
+
+    def close(self):
+        super(decompression_pipe, self).close()
+        # Stop the process if the stream was closed before being fully read
+        if self.proc.poll() is None:
+            self.proc.kill()
+        if self.proc.wait() > 0:
+            raise IOError("Command %s failed with exit status %d" % (' '.join(self.proc.args), self.proc.returncode))
+
 class missing_value_tracker(object):
     """ Class detailing missing value info for feature matrices
     """
     def __init__(self, missingValueList = ['NA', 'na']):
         self.missingValues = set(missingValueList)
         self.features = set([])
-        self.feature_mat_indices_psmIds = [] # row and column info for missing values
+        # row and column info for missing values, stored as parallel arrays
+        self.rows = np.empty(0, dtype = np.int32)
+        self.cols = np.empty(0, dtype = np.int32)
+        self.psmIds = []
 
-    def found_missing_value(self, feature_name, row, col, psmId):
-        self.features.add(feature_name)
-        self.feature_mat_indices_psmIds.append((row,col, psmId))
+    def found_missing_values(self, feature_names, rows, cols, psmIds):
+        """ Record a batch of missing values, given parallel arrays of rows, columns, and PSM ids
+        """
+        self.features.update(feature_names)
+        self.rows = np.concatenate((self.rows, np.asarray(rows, dtype = np.int32)))
+        self.cols = np.concatenate((self.cols, np.asarray(cols, dtype = np.int32)))
+        self.psmIds.extend(psmIds)
 
     def get_missing_cols(self):
-        return list(set([j for (_,j, _) in self.feature_mat_indices_psmIds]))
+        return np.unique(self.cols).tolist()
 
     def get_missing_rows(self):
-        return [i for (i,_, _) in self.feature_mat_indices_psmIds]
+        return self.rows.tolist()
+
+    def get_missing_rows_per_col(self):
+        """ Return dictionary mapping each column with missing values to an array of its missing rows
+        """
+        order = np.argsort(self.cols, kind = 'stable')
+        cols, starts = np.unique(self.cols[order], return_index = True)
+        return dict(zip(cols.tolist(), np.split(self.rows[order], starts[1:])))
 
     def get_missing_psmIds(self):
-        return [k for (_,_, k) in self.feature_mat_indices_psmIds]
+        return list(self.psmIds)
 
     def get_features_with_missing_values(self):
         return self.features
@@ -399,19 +501,18 @@ class PSM(object):
         self.right_flanking_aa = ''
 
         # Check if there were multiple proteins
-        l = protein.split('\t')
-        if len(l) == 1:
-            self.protein = l[0]
-        elif len(l) > 1:
-            self.protein = set(l)
+        if '\t' in protein:
+            self.protein = set(protein.split('\t'))
         else:
-            raise ValueError("No protein(s) supplied for PSM %s, exitting" % (psmId))
+            self.protein = protein
 
         # TODO: Add support for reading modifications from an input file
-        if len(sequence.split('.')) > 1: # flanking information included, split string
-            s  = sequence.split('.')
-            # should be 3 strings after the split
+        m = _flanked_peptide_re.match(sequence)
+        if m: # flanking information included
             # TODO: some checking to make sure flanking amino acids are valid
+            self.left_flanking_aa, self.peptide, self.right_flanking_aa = m.groups()
+        elif '.' in sequence: # partial flanking information, split string
+            s  = sequence.split('.')
             self.left_flanking_aa = s[0]
             self.right_flanking_aa = s[-1]
             self.peptide = s[1]
@@ -422,6 +523,27 @@ class PSM(object):
     def __str__(self):
         return "%s-%s" % (self.psmId, self.peptide)
 
+class psm_string_collection(object):
+    """ Sequence of PSM string info, stored as parallel arrays of PSM ids, peptides,
+        and proteins.  PSM objects are only constructed when accessed
+    """
+    def __init__(self, psmIds, peptides, proteins):
+        self.psmIds = psmIds
+        self.peptides = peptides
+        self.proteins = proteins
+
+    def __len__(self):
+        return len(self.psmIds)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return PSM(self.psmIds[i], self.peptides[i], self.proteins[i])
+
+    def __iter__(self):
+        for psmId, peptide, protein in zip(self.psmIds, self.peptides, self.proteins):
+            yield PSM(psmId, peptide, protein)
+
 class psm_imputer(object):
     """ Imputation class
     """
@@ -429,23 +551,33 @@ class psm_imputer(object):
                  alpha = 1.,
                  l1_ratio = 0.5,
                  verb = 0, 
-                 debug_mode = False):
+                 debug_mode = False,
+                 num_threads = mp.cpu_count()):
         self.pinfile = pinfile
         self.regressor = regressor
         self.alpha = alpha
         self.l1_ratio = l1_ratio
         self.linr = None # regression function
+        self.standardize_features = False # standardize regression inputs before fitting
+        self.num_threads = num_threads # regressions for different features are fit in parallel, each possibly using multithreaded BLAS
         self.debug_mode = debug_mode
         self.verb = verb
 
         if debug_mode:
             self.verb = 10 # set to max
 
-        # Find missing values in supplied PIN file
+        # Load PIN file once
+        self.pin_df = load_pin_dataframe(pinfile)
+
+        # Load feature matrix and find missing values in supplied PIN file
         # na_tracker is a missing_value_tracker object
-        self.na_tracker = find_missingVals(pinfile, verb = self.verb)
+        (self.na_tracker, self.feature_matrix, 
+         _, _, self.feature_keys) = load_percolator_feature_matrix_with_nas(pinfile, 
+                                                                            verb = self.verb, 
+                                                                            pin_df = self.pin_df)
         # grab NA info
         self.na_rows = self.na_tracker.get_missing_rows()
+        self.na_rows_set = set(self.na_rows) # rows with at least one missing value
         self.na_cols = self.na_tracker.get_missing_cols()
         self.na_feature_names = self.na_tracker.get_features_with_missing_values()
         if self.verb:
@@ -455,7 +587,7 @@ class psm_imputer(object):
         ############################
         # Imputed value
         ############################
-        self.imputed_vals_dict = {}
+        self.imputed_vals_dict = {} # feature name -> imputed values, indexed by row
 
         ###############################
         # Variables for feature subsets
@@ -508,7 +640,9 @@ class psm_imputer(object):
                 print("Regression alpha = %f, l1_ration = %f" % (self.alpha, self.l1_ratio))
             self.linr = linear_model.ElasticNet(alpha = alpha, l1_ratio = l1_ratio)
         else:
-            self.linr = linear_model.LinearRegression(normalize = True)
+            # Inputs are standardized once in impute, rather than per fit
+            self.linr = linear_model.LinearRegression()
+        self.standardize_features = isinstance(self.linr, linear_model.LinearRegression)
 
     def given_subset_update_na_cols(self, feature_keys):
         """ Find position of na features in supplied feature_keys list
@@ -524,30 +658,29 @@ class psm_imputer(object):
 
     def impute(self, cv_ratio = 0.0):
         """ Perform imputation in the following steps: 
-            1.) Load missing value info (*should be* performed on initialization),
-            2.) Load feature matrix from pinfile
+            1.) Load missing value info and feature matrix (*should be* performed on initialization),
+            2.) Select subset of features, if specified
             3.) Perform imputation by solving optimization problem
         """
         feature_subset = self.feature_subset
-        # input pin file
-        pinfile = self.pinfile
 
         # Optimization problem
         linr = self.linr
 
         # Missing value info
         na_tracker = self.na_tracker
-        na_rows = self.na_rows
         na_cols = self.na_cols
-        na_feature_names = self.na_feature_names
 
-        # Load feature matrix
-        feature_matrix, _, _, row_keys = load_percolator_feature_matrix(pinfile,
-                                                                        na_rows = na_rows,
-                                                                        na_features = na_feature_names, 
-                                                                        feature_subset = feature_subset)
+        # Feature matrix (loaded on initialization)
+        feature_matrix = self.feature_matrix
+        row_keys = self.feature_keys
 
-        if not feature_subset.is_empty: # Update na column if using subset of features
+        if not feature_subset.is_empty: # Select subset of features and update na columns
+            row_keys = feature_subset.return_overlapping_features(self.feature_keys)
+            print("Overlapping features:")
+            print(row_keys)
+            subset_cols = [self.feature_keys.index(k) for k in row_keys]
+            feature_matrix = feature_matrix[:, subset_cols]
             self.given_subset_update_na_cols(row_keys)
             na_cols = self.na_cols
         
@@ -557,59 +690,74 @@ class psm_imputer(object):
         if self.verb:
             print("Finished loading feature matrix from PIN file")
 
-        missing_rows = list(na_rows) # rows containing missing values
-        full_rows = list([i for i in range(nr) if i not in set(na_rows)])
-        random.shuffle(full_rows)
-        nonmissing_columns = [i for i in range(nc) if i not in set(na_cols)]
+        missing_rows = list(self.na_rows_set) # rows containing missing values
+        # boolean masks for fully observed rows and columns
+        full_rows = np.ones(nr, dtype = bool)
+        full_rows[missing_rows] = False
+        nonmissing_columns = np.ones(nc, dtype = bool)
+        nonmissing_columns[na_cols] = False
         if cv_ratio:
-            train_test_partition = int(len(full_rows) * (1. - cv_ratio))
-            cv_rows = list(full_rows[train_test_partition:])
-            full_rows = full_rows[:train_test_partition]
-            
+            full_row_inds = np.flatnonzero(full_rows)
+            np.random.shuffle(full_row_inds)
+            train_test_partition = int(len(full_row_inds) * (1. - cv_ratio))
+            cv_rows = full_row_inds[train_test_partition:]
+            full_rows[cv_rows] = False
 
         if self.verb >= 0:
             print("Imputing missing values")
-        X = feature_matrix[np.ix_(full_rows, nonmissing_columns)]
-        Y = feature_matrix[np.ix_(full_rows, na_cols)]
-        # train regressor
-        linr.fit(X,Y)
-
+        observed_features = feature_matrix[:, nonmissing_columns]
+        if self.standardize_features:
+            # Standardize using training statistics, shared by all fits
+            mu = observed_features[full_rows].mean(axis = 0)
+            sd = observed_features[full_rows].std(axis = 0)
+            sd[sd == 0] = 1.
+            observed_features -= mu
+            observed_features /= sd
+        training_rows = feature_matrix[full_rows]
+        X = observed_features[full_rows]
+        X_cv = None
         if cv_ratio:
-            # Score learned parameters
-            X = feature_matrix[np.ix_(cv_rows, nonmissing_columns)]
-            Y = feature_matrix[np.ix_(cv_rows, na_cols)]
-            validation_scores = linr.score(X,Y)
-            print("Validation scores on %f of data = %f" % (cv_ratio, validation_scores))
-            
-        # form test data
-        X = feature_matrix[np.ix_(missing_rows, nonmissing_columns)]
-        imputed_vals = linr.predict(X).reshape(-1)
-        for i, ind in zip(imputed_vals, missing_rows):
-            self.imputed_vals_dict[ind] = i
+            cv_feature_matrix = feature_matrix[cv_rows]
+            X_cv = observed_features[cv_rows]
+
+        # rows missing each feature
+        rows_per_col = na_tracker.get_missing_rows_per_col()
+        na_rows_per_col = [rows_per_col[self.feature_keys.index(row_keys[c])] for c in na_cols]
+
+        # Fit a separate regressor per feature with missing values, in parallel. The
+        # fits release the GIL, so threads avoid copying the training data per worker
+        n_jobs = max(1, min(self.num_threads, len(na_cols)))
+        results = Parallel(n_jobs = n_jobs, prefer = 'threads')(
+            delayed(fit_and_impute_feature)(clone(linr), X, training_rows[:, c],
+                                            observed_features[rows],
+                                            X_cv, cv_feature_matrix[:, c] if cv_ratio else None)
+            for c, rows in zip(na_cols, na_rows_per_col))
+
+        for c, rows, (imputed_vals, validation_score) in zip(na_cols, na_rows_per_col, results):
+            if cv_ratio:
+                print("Validation score for feature %s on %f of data = %f" % (row_keys[c], cv_ratio, validation_score))
+            self.imputed_vals_dict[row_keys[c]] = pd.Series(imputed_vals, index = rows)
 
     def write_imputed_values(self, outputpin, gzipOutput = True):
         assert self.imputed_vals_dict != {}, "Please impute values before calling write_imputed_values.  Exitting"
         
-        imputed_vals_per_na_row = self.imputed_vals_dict
+        imputed_vals_per_na_feature = self.imputed_vals_dict
         impute_debug = self.debug_mode
         # input pin file
         pinfile = self.pinfile
+        pin_df = self.pin_df
 
-        # Missing value info
-        na_tracker = self.na_tracker
-        na_rows = self.na_rows
-        na_cols = self.na_cols
-        na_feature_names = self.na_feature_names
-
-        # hashtable for rows that do not need further processing
-        rows_with_na = set(na_rows)
+        # per-row flag for rows that need further processing; a list of bools
+        # is indexed without creating NumPy scalars in the row loop
+        is_na_row = np.zeros(len(self.feature_matrix), dtype = bool)
+        is_na_row[self.na_rows] = True
+        is_na_row = is_na_row.tolist()
 
         ref_key = 'spectral_contrast_angle'
         
-        broken_constraints = 0
         with checkGzip_openfile(pinfile, 'r') as f:
-            r = csv.DictReader(f, delimiter = '\t', skipinitialspace = True)
-            headerInOrder =  r.fieldnames
+            r = csv.reader(f, delimiter = '\t', skipinitialspace = True)
+            headerInOrder = next(r)
             psmId_field = 'SpecId'
             if psmId_field not in headerInOrder:
                 psmId_field = 'PSMId'
@@ -629,6 +777,9 @@ class psm_imputer(object):
 
             preKeys = [psmId_field, 'Label', 'ScanNr']
             postKeys = ['Peptide', p]
+            missingKeys = [k for k in preKeys + postKeys if k not in headerInOrder]
+            if missingKeys:
+                raise ValueError("No %s field in PIN file %s, exitting" % (', '.join(missingKeys), pinfile))
             constKeys = set(nonFeatureKeys) # exclude these when reserializing dat
             keys = []
             for h in headerInOrder: # keep order of keys intact
@@ -637,79 +788,64 @@ class psm_imputer(object):
 
             if os.path.splitext(outputpin)[1] == '.gz':
                 outputpin = outputpin[:-3]
+            if gzipOutput:
+                outputpin += '.gz'
 
-            na_feat = na_tracker.get_features_with_missing_values().pop()
             with checkGzip_openfile(outputpin, 'w') as g:
                 # write new pin file header
-                for k in preKeys:
-                    g.write("%s\t" % k)
-                for k in keys[:-1]:
-                    g.write("%s\t" % k)
-                # Preserve the number of tabs
-                g.write("%s" % keys[-1])
-                for k in postKeys:
-                    g.write("\t%s" % k)
-                g.write("\n")
-
-                ####################################
-                ############ Imputation debugging
-                ####################################
-                if impute_debug:
-                    non_imputed_vals = []
-                    imputed_vals = []
-                    target_imputed_vals = []
-                    decoy_imputed_vals = []
-
-                for i, dict_l in enumerate(r):
-                    psmId = dict_l[psmId_field]
-                    if i in rows_with_na:
-                        dict_l[na_feat] = imputed_vals_per_na_row[i]
-                    ####################################
-                    ############ Imputation debugging
-                    ####################################
-                    if impute_debug:
-                        if i in rows_with_na:
-                            imputed_vals.append(dict_l[na_feat])
-                            rk = float(dict_l[ref_key])
-                            if (rk != 0 and dict_l[na_feat] != 0) and dict_l[na_feat] < rk:
-                                broken_constraints += 1
-                                print("imputed val = %f, ref val = %f" % (dict_l[na_feat], float(dict_l[ref_key])))
-
-                            # target/decoy distributions
-                            y = int(dict_l["Label"])
-                            if y == 1:
-                                target_imputed_vals.append(dict_l[na_feat])
-                            elif y == -1:
-                                decoy_imputed_vals.append(dict_l[na_feat])
-                            else:
-                                print("Countered improper label on line %d" % (i))
-                                exit(-1)
-
-                        else:
-                            non_imputed_vals.append(float(dict_l[na_feat]))
-                        
-                    for k in preKeys:
-                        g.write("%s\t" % dict_l[k])
-                    for k in keys[:-1]:
-                        g.write("%s\t" % dict_l[k])
-                    # Preserve the number of tabs
-                    g.write("%s" % dict_l[keys[-1]])
-                    for k in postKeys:
-                        g.write("\t%s" % dict_l[k])
-                    g.write("\n")
-
-                ####################################
-                ############ Imputation debugging
-                ####################################
-                if impute_debug:
-                    print("%d imputed values, %d broken constraints" % (len(imputed_vals), broken_constraints))
-                    histogram(non_imputed_vals, imputed_vals, 
-                              'imputed_hist.png', 
-                              target_string = 'Observed values', decoy_string = 'Imputed values')
-                    histogram(target_imputed_vals, decoy_imputed_vals,
-                              'td_imputed_hist.png', 
-                              target_string = 'Target imputed values', decoy_string = 'Decoy imputed values')
-
-            
-            if self.verb:
-                print("Wrote imputed values to output file %s" % (outputpin))
+                outKeys = preKeys + keys + postKeys
+                g.write('\t'.join(outKeys))
+                g.write('\n')
+                # position of each output field in the input rows
+                reorder = [headerInOrder.index(k) for k in outKeys]
+
+                # imputed values per row, as (input column, value) pairs; values are
+                # written as the shortest decimal string of each single precision value
+                imputed_vals_per_na_row = {}
+                for feature, feature_vals in imputed_vals_per_na_feature.items():
+                    j = headerInOrder.index(feature)
+                    for i, val in zip(feature_vals.index.tolist(), feature_vals.to_numpy().astype(str).tolist()):
+                        imputed_vals_per_na_row.setdefault(i, []).append((j, val))
+
+                # observed values are copied verbatim
+                for i, l in enumerate(r):
+                    if is_na_row[i]:
+                        for j, val in imputed_vals_per_na_row[i]:
+                            l[j] = val
+                    g.write('\t'.join([l[j] for j in reorder]))
+                    g.write('\n')
+
+        ####################################
+        ############ Imputation debugging
+        ####################################
+        if impute_debug:
+            # debugging info is collected for the first feature with missing values
+            na_feat = [k for k in keys if k in imputed_vals_per_na_feature][0]
+            feature_vals = imputed_vals_per_na_feature[na_feat]
+            imputed_rows = feature_vals.index.to_numpy()
+            imputed_vals = feature_vals.to_numpy()
+            observed_rows = np.ones(len(pin_df), dtype = bool)
+            observed_rows[imputed_rows] = False
+            non_imputed_vals = pin_df[na_feat].to_numpy()[observed_rows]
+
+            ref_vals = pin_df[ref_key].to_numpy()[imputed_rows]
+            broken = (ref_vals != 0) & (imputed_vals != 0) & (imputed_vals < ref_vals)
+            broken_constraints = int(broken.sum())
+            for imputed_val, rk in zip(imputed_vals[broken], ref_vals[broken]):
+                print("imputed val = %f, ref val = %f" % (imputed_val, rk))
+
+            # target/decoy distributions
+            labels = pin_df["Label"].to_numpy()[imputed_rows]
+            target_imputed_vals = imputed_vals[labels == 1]
+            decoy_imputed_vals = imputed_vals[labels == -1]
+
+            print("%d imputed values, %d broken constraints" % (len(imputed_vals), broken_constraints))
+            histogram(non_imputed_vals, imputed_vals, 
+                      'imputed_hist.png', 
+                      target_string = 'Observed values', decoy_string = 'Imputed values')
+            histogram(target_imputed_vals, decoy_imputed_vals,
+                      'td_imputed_hist.png', 
+                      target_string = 'Target imputed values', decoy_string = 'Decoy imputed values')
+
+        if self.verb:
+            print("Wrote imputed values to output file %s" % (outputpin))